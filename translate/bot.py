@@ -14,18 +14,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Optional, Tuple, Type, Dict, Union
+from collections import OrderedDict, Counter, defaultdict
+import asyncio
 
 from mautrix.util.config import BaseProxyConfig
-from mautrix.types import RoomID, EventType, MessageType
+from mautrix.types import RoomID, UserID, EventID, EventType, MessageType
 from maubot import Plugin, MessageEvent
 from maubot.handlers import command, event
 
-from .provider import AbstractTranslationProvider
-from .util import Config, LanguageCodePair, LanguageCodeAuto, TranslationProviderError, AutoTranslateConfig
-from .db import Database, Autotranslate
+from .provider import AbstractTranslationProvider, Result
+from .util import (Config, LanguageCodePair, LanguageCodeAuto, TranslationProviderError, AutoTranslateConfig,
+                   BudgetConfig, BudgetLevel, TranslatedMessage, match_sentences)
+from .db import Database, Autotranslate, GLOBAL_USAGE
+from .profiles import LanguageProfiles
+from .offload import Offloader
 
 try:
     import langdetect
+    import langdetect.detector_factory
     from langdetect.lang_detect_exception import LangDetectException
 except ImportError:
     langdetect = None
@@ -40,6 +46,12 @@ class TranslatorBot(Plugin):
     db: Database
     translator: Optional[AbstractTranslationProvider]
     auto_translate: Dict[RoomID, AutoTranslateConfig]
+    budget: BudgetConfig
+    translations: 'OrderedDict[EventID, Dict[str, TranslatedMessage]]'
+    profiles: LanguageProfiles
+    detections_skipped: int
+    offloader: Optional[Offloader]
+    speculations: Dict[RoomID, Counter]
     config: Config
 
     simmilar_languages = [["ko", "zh-CN", "zh-TW", "zh-cn"], ["de", "fi", "pl", "hu"]]
@@ -47,14 +59,40 @@ class TranslatorBot(Plugin):
     async def start(self) -> None:
         await super().start()
         self.db = Database(self.database)
+        self.translations = OrderedDict()
+        self.detections_skipped = 0
+        self.offloader = None
+        self.profiles = None
+        self.speculations = defaultdict(Counter)
+        if langdetect:
+            # langdetect loads its profiles lazily, which isn't safe once detection runs in several threads
+            langdetect.detector_factory.init_factory()
         self.on_external_config_update()
 
+    async def stop(self) -> None:
+        await super().stop()
+        if self.offloader:
+            self.offloader.stop()
+
     def on_external_config_update(self) -> None:
         self.translator = None
         self.config.load_and_update()
+        # The offloader is reconfigured instead of replaced, as translations that are already running
+        # keep using it
+        if self.offloader:
+            self.offloader.set_config(self.config.load_offload())
+        else:
+            self.offloader = Offloader(self.config.load_offload())
+        self.offloader.start()
         self.auto_translate = self.config.load_auto_translate()
+        self.budget = self.config.load_budget()
+        if self.profiles:
+            self.profiles.set_config(self.config.load_profiles(), self.db)
+        else:
+            self.profiles = LanguageProfiles(self.config.load_profiles(), self.db)
         try:
             self.translator = self.config.load_translator()
+            self.translator.offloader = self.offloader
         except TranslationProviderError:
             self.log.exception("")
 
@@ -92,6 +130,150 @@ class TranslatorBot(Plugin):
     async def show_subscriptions(self, evt: MessageEvent) -> None:
         await evt.reply(self.subscriptions(evt))
 
+    async def translate_text(self, room_id: RoomID, text: str, to_lang: str, from_lang: str = "auto") -> Result:
+        self.db.add_usage(room_id, len(text), self.budget.window)
+        self.db.add_usage(GLOBAL_USAGE, len(text), self.budget.window)
+        return await self.translator.translate(text, to_lang=to_lang, from_lang=from_lang)
+
+    def _limit_level(self, chars: int, limit: int) -> BudgetLevel:
+        if limit <= 0:
+            return BudgetLevel.OK
+        if chars >= limit:
+            return BudgetLevel.EXHAUSTED
+        if chars >= limit * self.budget.degrade_at:
+            return BudgetLevel.DEGRADED
+        return BudgetLevel.OK
+
+    def budget_level(self, room_id: RoomID) -> BudgetLevel:
+        room_level = self._limit_level(self.db.get_usage(room_id, self.budget.window).chars,
+                                       self.budget.room_limit)
+        global_level = self._limit_level(self.db.get_usage(GLOBAL_USAGE, self.budget.window).chars,
+                                         self.budget.global_limit)
+        if room_id in self.budget.priority_rooms and global_level == BudgetLevel.DEGRADED:
+            global_level = BudgetLevel.OK
+        return max(room_level, global_level)
+
+    def is_admin(self, user_id: UserID) -> bool:
+        return user_id in (self.config["admins"] or [])
+
+    def stats(self, evt: MessageEvent) -> str:
+        def fmt(chars: int, limit: int) -> str:
+            return f"{chars}/{limit}" if limit > 0 else f"{chars}"
+
+        room = self.db.get_usage(evt.room_id, self.budget.window)
+        lines = [f"__Characters sent to {self.config['provider']['id']}__ "
+                 f"(window: {int(self.budget.window.total_seconds())}s)",
+                 f"- this room: {fmt(room.chars, self.budget.room_limit)} "
+                 f"({self.budget_level(evt.room_id).name.lower()})"]
+        speculations = self.speculations[evt.room_id]
+        lines.append(f"- speculative translations in this room: {speculations['used']} used, "
+                     f"{speculations['wasted']} wasted")
+        if not self.is_admin(evt.sender):
+            return "\n".join(lines)
+
+        total = self.db.get_usage(GLOBAL_USAGE, self.budget.window)
+        rooms = sorted((usage for usage in self.db.get_all_usage(self.budget.window)
+                        if usage.room_id != GLOBAL_USAGE),
+                       key=lambda usage: usage.chars, reverse=True)
+        lines.append(f"- all rooms: {fmt(total.chars, self.budget.global_limit)}")
+        lines += [f"  - {usage.room_id}: {fmt(usage.chars, self.budget.room_limit)}" for usage in rooms[:10]]
+        lines.append(f"- language detections skipped thanks to sender profiles: {self.detections_skipped}")
+        lines.append(f"- event loop lag: {self.offloader.lag_avg * 1000:.1f} ms average, "
+                     f"{self.offloader.lag_max * 1000:.1f} ms max")
+        if self.offloader.executor:
+            lines.append(f"- text processing steps: {self.offloader.offloaded} offloaded to "
+                         f"{self.offloader.config.type} executor, {self.offloader.inline} inline")
+        else:
+            lines.append(f"- text processing offloading disabled, {self.offloader.inline} steps inline")
+        return "\n".join(lines)
+
+    @staticmethod
+    def message_body(evt: MessageEvent) -> str:
+        if not evt.content.get_edit():
+            return evt.content.body
+        new_content = getattr(evt.content, "new_content", None) or evt.content.get("m.new_content")
+        if isinstance(new_content, dict):
+            return new_content.get("body", "")
+        elif new_content:
+            return new_content.body
+        # Strip the fallback prefix of edits from clients that don't send m.new_content
+        return evt.content.body[2:] if evt.content.body.startswith("* ") else evt.content.body
+
+    @staticmethod
+    def format_translation(evt: MessageEvent, label: str, to_lang: str, text: str) -> str:
+        return (f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                f"*(in {label}) "
+                f"__{to_lang}__*: "
+                f"{text}")
+
+    async def respond_translation(self, evt: MessageEvent, label: str, to_lang: str, result: Result) -> None:
+        event_id = await evt.respond(self.format_translation(evt, label, to_lang, result.text))
+        cache_size = self.config["edit_cache_size"]
+        if cache_size <= 0:
+            return
+        original_id = evt.content.get_edit() or evt.event_id
+        self.translations.setdefault(original_id, {})[to_lang] = TranslatedMessage(
+            event_id=event_id, sender=evt.sender, label=label, from_lang=result.source_language,
+            sentences=result.sentences)
+        self.translations.move_to_end(original_id)
+        while len(self.translations) > cache_size:
+            self.translations.popitem(last=False)
+
+    async def update_translations(self, evt: MessageEvent, body: str,
+                                  translations: Dict[str, TranslatedMessage]) -> None:
+        for to_lang, translated in translations.items():
+            if translated.sender != evt.sender:
+                self.log.debug(f"Ignoring edit of a message by {translated.sender} from {evt.sender}")
+                return
+            parts = match_sentences(body, translated.sentences)
+            known = [source for source, _ in translated.sentences if source.strip()]
+            changed = [source for _, source, translation in parts if translation is None]
+            if len(parts) == len(known) and not changed:
+                continue
+            # Changed parts are translated in a single request, one per line. Retranslate everything
+            # instead when most of the message changed or the lines can't be matched up reliably.
+            # Edits that only removed sentences don't need the provider at all.
+            full = len(changed) * 2 > len(parts) or any("\n" in source for source in changed)
+            translated_lines = []
+            if changed:
+                try:
+                    result = await self.translate_text(evt.room_id, body if full else "\n".join(changed),
+                                                       to_lang=to_lang, from_lang=translated.from_lang)
+                except:
+                    await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                                      f"Provider __{self.config['provider']['id']}__ not reachable!!")
+                    return
+                translated_lines = [line.strip() for line in result.text.split("\n")]
+            if changed and (full or len(translated_lines) != len(changed)):
+                if not full:
+                    try:
+                        result = await self.translate_text(evt.room_id, body, to_lang=to_lang,
+                                                           from_lang=translated.from_lang)
+                    except:
+                        await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                                          f"Provider __{self.config['provider']['id']}__ not reachable!!")
+                        return
+                text = result.text
+                sentences = result.sentences
+            else:
+                translated_lines = iter(translated_lines)
+                sentences = []
+                text = ""
+                for separator, source, translation in parts:
+                    if translation is None:
+                        translation = next(translated_lines)
+                    sentences.append((source, translation))
+                    text += separator + translation
+            await evt.respond(self.format_translation(evt, translated.label, to_lang, text),
+                              edits=translated.event_id)
+            translations[to_lang] = translated._replace(sentences=sentences)
+
+    def discard_speculation(self, room_id: RoomID, speculation: asyncio.Future) -> None:
+        if not speculation.cancel() and not speculation.cancelled():
+            # Retrieve the exception so that asyncio doesn't complain about it never being retrieved
+            speculation.exception()
+        self.speculations[room_id]["wasted"] += 1
+
     def is_acceptable(self, lang: str, accepted_languages: list) -> Union[str, bool]:
         if len(accepted_languages) == 0 or lang in accepted_languages:
             return lang
@@ -110,11 +292,12 @@ class TranslatorBot(Plugin):
 
     @event.on(EventType.ROOM_MESSAGE)
     async def event_handler(self, evt: MessageEvent) -> None:
+        body = self.message_body(evt)
         if (
                 langdetect is None
                 or evt.content.msgtype == MessageType.NOTICE
                 or evt.sender == self.client.mxid
-                or evt.content.body[0:3] == '!tr'
+                or body[0:3] == '!tr'
         ):
             return
 
@@ -124,6 +307,10 @@ class TranslatorBot(Plugin):
             atc = atc_db
             accepted_languages = atc.source_lang.split(" ")
             main_language = atc.target_lang.split(" ")
+            try:
+                speculative = self.auto_translate[evt.room_id].speculative
+            except KeyError:
+                speculative = self.config["speculative_translation"]
 
         else:
             # acquire auto translate configuration from file
@@ -131,74 +318,141 @@ class TranslatorBot(Plugin):
                 atc = self.auto_translate[evt.room_id]
                 accepted_languages = atc.accepted_languages
                 main_language = atc.main_language
+                speculative = atc.speculative
             except KeyError:
                 return
 
-        detected_lang = langdetect.detect(evt.content.body)
-        self.log.warn(f"translation language detected: {detected_lang}")
-        if self.is_acceptable_soft(detected_lang, accepted_languages):
-            for atc_main_language in main_language:
-                if atc_main_language != detected_lang:
-                    try:
-                        result = await self.translator.translate(evt.content.body, to_lang=atc_main_language,
-                                                                 from_lang=detected_lang)
-                    except:
-                        await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                          f"Provider __{self.config['provider']['id']}__ not reachable!!")
-                        return
-                    await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                      f"*(in {result.source_language}) "
-                                      f"__{atc_main_language}__*: "
-                                      f"{result.text}")
+        # Only rooms configured with a single main language translate speculatively, and only while they are
+        # within their character budget
+        speculative = speculative and len(main_language) == 1
+        budget_level = self.budget_level(evt.room_id)
+        if budget_level != BudgetLevel.OK:
+            speculative = False
+        if budget_level == BudgetLevel.EXHAUSTED:
+            self.log.debug(f"Character budget of {evt.room_id} exhausted, not translating")
+            return
+        elif budget_level == BudgetLevel.DEGRADED:
+            main_language = main_language[:1]
+
+        edits = evt.content.get_edit()
+        if edits and edits in self.translations:
+            self.translations.move_to_end(edits)
+            await self.update_translations(evt, body, self.translations[edits])
+            return
+
+        use_profiles = self.profiles.config.enabled
+        prior = self.profiles.prior(evt.room_id, evt.sender) if use_profiles else None
+        # Senders writing in a main language are still detected, so that a switch to another language is
+        # noticed, but the profile lets a matching detection skip the provider probing
+        prior_is_main = prior in (lang.lower() for lang in main_language)
+        from_prior = bool(prior and not prior_is_main and len(body) <= self.profiles.config.short_message)
+        speculation = None
+        if from_prior:
+            detected_lang = prior
+            self.detections_skipped += 1
         else:
+            if speculative:
+                # Request the translation while detecting, the detected language only decides if it's used
+                speculation = asyncio.ensure_future(self.translate_text(evt.room_id, body, to_lang=main_language[0]))
+                # Let the request get sent before detection starts
+                await asyncio.sleep(0)
             try:
-                result = await self.translator.translate(evt.content.body, to_lang=main_language[0])
-            except:
-                await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                  f"Provider __{self.config['provider']['id']}__ not reachable!!")
+                # Detection has to leave the loop for the speculative request to progress meanwhile
+                detected_lang = await self.offloader.run(len(body), langdetect.detect, body,
+                                                         force=speculation is not None)
+            except Exception:
+                if speculation:
+                    self.discard_speculation(evt.room_id, speculation)
+                raise
+            if prior_is_main and detected_lang.lower() == prior:
+                if speculation:
+                    self.discard_speculation(evt.room_id, speculation)
+                self.profiles.update(evt.room_id, evt.sender, detected_lang)
                 return
-            from_lang = 'auto'
-            if self.is_acceptable(result.source_language, accepted_languages):
-                from_lang = result.source_language
-                await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                  f"*(in {from_lang}) "
-                                  f"__{main_language[0]}__*: "
-                                  f"{result.text}")
-                for atc_main_language in main_language[1:]:
-                    try:
-                        result = await self.translator.translate(evt.content.body, to_lang=atc_main_language,
-                                                                 from_lang=from_lang)
-                    except:
-                        await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                          f"Provider __{self.config['provider']['id']}__ not reachable!!")
-                        return
-                    self.log.warn(f"language detected --: {result.source_language}  {atc_main_language}")
-                    accept_lang = self.is_acceptable(result.source_language, accepted_languages)
-                    if (accept_lang
-                            and result.source_language != atc_main_language
-                            and result.text != evt.content.body):
-                        await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                          f"*(in {from_lang}) "
-                                          f"__{atc_main_language}__*: "
-                                          f"{result.text}")
-            else:
+        self.log.warn(f"translation language detected: {detected_lang}")
+        # The language the provider reported for the message, which is preferred over local detection
+        # when updating the sender's profile
+        provider_lang = None
+        try:
+            if self.is_acceptable_soft(detected_lang, accepted_languages):
+                if speculation and detected_lang == main_language[0]:
+                    self.discard_speculation(evt.room_id, speculation)
                 for atc_main_language in main_language:
-                    for atc_accepted_language in accepted_languages:
-                        if atc_main_language != atc_accepted_language:
-                            try:
-                                result = await self.translator.translate(evt.content.body, to_lang=atc_main_language,
-                                                                         from_lang=atc_accepted_language)
-                            except:
-                                await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                                  f"Provider __{self.config['provider']['id']}__ not reachable!!")
-                                return
-                            self.log.warn(f"language detected 01: {result.source_language}  {atc_main_language}")
-                            if (result.source_language != atc_main_language
-                                    and result.text.strip().lower() != evt.content.body.strip().lower()):
-                                await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
-                                                  f"*(in {atc_accepted_language}) "
-                                                  f"__{atc_main_language}__*: "
-                                                  f"{result.text}")
+                    if atc_main_language != detected_lang:
+                        # Let the provider detect the language of messages attributed by the sender profile
+                        # so that a wrong profile gets corrected
+                        from_lang = provider_lang or ("auto" if from_prior else detected_lang)
+                        try:
+                            result = await (speculation
+                                            or self.translate_text(evt.room_id, body, to_lang=atc_main_language,
+                                                                   from_lang=from_lang))
+                        except:
+                            await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                                              f"Provider __{self.config['provider']['id']}__ not reachable!!")
+                            return
+                        provider_lang = provider_lang or result.source_language
+                        if result.source_language.lower() == atc_main_language.lower():
+                            if speculation:
+                                self.speculations[evt.room_id]["wasted"] += 1
+                            continue
+                        if speculation:
+                            self.speculations[evt.room_id]["used"] += 1
+                        await self.respond_translation(evt, result.source_language, atc_main_language, result)
+            else:
+                try:
+                    result = await (speculation
+                                    or self.translate_text(evt.room_id, body, to_lang=main_language[0]))
+                except:
+                    await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                                      f"Provider __{self.config['provider']['id']}__ not reachable!!")
+                    return
+                provider_lang = result.source_language
+                from_lang = 'auto'
+                if speculation:
+                    # The speculative result is only used if it gets posted
+                    counter = "used" if self.is_acceptable(result.source_language, accepted_languages) else "wasted"
+                    self.speculations[evt.room_id][counter] += 1
+                if self.is_acceptable(result.source_language, accepted_languages):
+                    from_lang = result.source_language
+                    await self.respond_translation(evt, from_lang, main_language[0], result)
+                    for atc_main_language in main_language[1:]:
+                        try:
+                            result = await self.translate_text(evt.room_id, body, to_lang=atc_main_language,
+                                                               from_lang=from_lang)
+                        except:
+                            await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                                              f"Provider __{self.config['provider']['id']}__ not reachable!!")
+                            return
+                        self.log.warn(f"language detected --: {result.source_language}  {atc_main_language}")
+                        accept_lang = self.is_acceptable(result.source_language, accepted_languages)
+                        if (accept_lang
+                                and result.source_language != atc_main_language
+                                and result.text != body):
+                            await self.respond_translation(evt, from_lang, atc_main_language, result)
+                else:
+                    for atc_main_language in main_language:
+                        for atc_accepted_language in accepted_languages:
+                            if atc_main_language != atc_accepted_language:
+                                try:
+                                    result = await self.translate_text(evt.room_id, body,
+                                                                       to_lang=atc_main_language,
+                                                                       from_lang=atc_accepted_language)
+                                except:
+                                    await evt.respond(f"[{evt.sender}](https://matrix.to/#/{evt.sender}) "
+                                                      f"Provider __{self.config['provider']['id']}__ "
+                                                      f"not reachable!!")
+                                    return
+                                self.log.warn(f"language detected 01: {result.source_language}  "
+                                              f"{atc_main_language}")
+                                if (result.source_language != atc_main_language
+                                        and result.text.strip().lower() != body.strip().lower()):
+                                    await self.respond_translation(evt, atc_accepted_language, atc_main_language,
+                                                                   result)
+        finally:
+            # Every message updates the sender's profile once. Messages attributed by the profile itself
+            # only count when the provider confirmed or corrected the language.
+            if use_profiles and (provider_lang or not from_prior):
+                self.profiles.update(evt.room_id, evt.sender, provider_lang or detected_lang)
 
     @command.new("translate", aliases=["tr"])
     @LanguageCodeAuto("auto", required=False)
@@ -215,6 +469,7 @@ class TranslatorBot(Plugin):
 - setauto [<to>] - Automatically translate all languages to a list of languages in this room.
 - unsetauto - Stop automatically translating text in this room.
 - show - Show automatic translation settings for this room.
+- stats - Show how many characters this room sent to the translation provider (all rooms for admins).
 
 """
         if auto == 'setauto' and not language:
@@ -233,6 +488,9 @@ class TranslatorBot(Plugin):
         if auto == 'show':
             await self.show_subscriptions(evt=evt)
             return
+        if auto == 'stats':
+            await evt.reply(self.stats(evt))
+            return
         if not language or auto == 'help':
             await evt.reply(help_response + self.subscriptions(evt))
             return
@@ -250,11 +508,14 @@ class TranslatorBot(Plugin):
         if not text:
             await evt.reply("Usage: !translate [from] <to> [text or reply to message]")
             return
+        if self.budget_level(evt.room_id) == BudgetLevel.EXHAUSTED:
+            await evt.reply("The character budget of this room is used up, try again later.")
+            return
         results = []
         for target in language[1]:
             for source in language[0]:
                 self.log.warn(f"cmd: language given:    {source}  {target}")
-                result = await self.translator.translate(text, to_lang=target, from_lang=source)
+                result = await self.translate_text(evt.room_id, text, to_lang=target, from_lang=source)
                 if source == 'auto':
                     results.append(f"_{result.source_language}_ -> __{target}__: {result.text}")
                 else:
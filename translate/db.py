@@ -14,10 +14,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Iterable, NamedTuple, List, Optional, Dict, Tuple
-from datetime import datetime
+from datetime import datetime, timedelta
 from string import Template
 
-from sqlalchemy import (Column, String, Integer, DateTime, Text, Boolean, ForeignKey,
+from sqlalchemy import (Column, String, Integer, Float, DateTime, Text, Boolean, ForeignKey,
                         Table, MetaData,
                         select, and_, true)
 from sqlalchemy.engine.base import Engine
@@ -26,11 +26,17 @@ from mautrix.types import UserID, RoomID
 
 Autotranslate = NamedTuple("Autotranslate", room_id=RoomID, user_id=UserID, source_lang=str, target_lang=str,
         provider=str)
+Usage = NamedTuple("Usage", room_id=RoomID, window_start=datetime, chars=int)
+
+# Key of the usage row that counts characters sent to the provider from all rooms.
+GLOBAL_USAGE = RoomID("*")
 
 
 class Database:
     db: Engine
     autotranslate: Table
+    usage: Table
+    language_profile: Table
     version: Table
 
     def __init__(self, db: Engine) -> None:
@@ -43,6 +49,15 @@ class Database:
                                   Column("target_lang", String(255), nullable=False),
                                   Column("provider", String(255))
                                   )
+        self.usage = Table("usage", metadata,
+                           Column("room_id", String(255), primary_key=True),
+                           Column("window_start", DateTime, nullable=False),
+                           Column("chars", Integer, nullable=False, default=0))
+        self.language_profile = Table("language_profile", metadata,
+                                      Column("room_id", String(255), primary_key=True),
+                                      Column("user_id", String(255), primary_key=True),
+                                      Column("language", String(16), primary_key=True),
+                                      Column("weight", Float, nullable=False))
         self.version = Table("version", metadata,
                              Column("version", Integer, primary_key=True))
         self.upgrade()
@@ -62,6 +77,22 @@ class Database:
                 provider VARCHAR(255) NOT NULL
             )""")
             version = 1
+        if version == 1:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS usage (
+                room_id VARCHAR(255) PRIMARY KEY,
+                window_start TIMESTAMP NOT NULL,
+                chars INTEGER NOT NULL DEFAULT 0
+            )""")
+            version = 2
+        if version == 2:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS language_profile (
+                room_id VARCHAR(255) NOT NULL,
+                user_id VARCHAR(255) NOT NULL,
+                language VARCHAR(16) NOT NULL,
+                weight FLOAT NOT NULL,
+                PRIMARY KEY (room_id, user_id, language)
+            )""")
+            version = 3
         self.db.execute(self.version.delete())
         self.db.execute(self.version.insert().values(version=version))
 
@@ -77,6 +108,12 @@ class Database:
         self.db.execute(self.autotranslate.update()
                         .where(self.autotranslate.c.room_id == old)
                         .values(room_id=new))
+        self.db.execute(self.usage.update()
+                        .where(self.usage.c.room_id == old)
+                        .values(room_id=new))
+        self.db.execute(self.language_profile.update()
+                        .where(self.language_profile.c.room_id == old)
+                        .values(room_id=new))
 
     def create_autotranslate(self, room_id: RoomID, user_id: UserID, source_lang: str, target_lang: str, provider: str) -> bool :
         res = self.db.execute(self.autotranslate.insert().values(room_id=room_id, user_id=user_id,
@@ -93,3 +130,49 @@ class Database:
         tbl = self.autotranslate
         self.db.execute(tbl.delete().where(and_(tbl.c.room_id == room_id)))
 
+    def get_usage(self, room_id: RoomID, window: timedelta) -> Usage:
+        rows = self.db.execute(select([self.usage]).where(self.usage.c.room_id == room_id))
+        try:
+            usage = Usage(*next(rows))
+        except (ValueError, StopIteration):
+            return Usage(room_id=room_id, window_start=datetime.utcnow(), chars=0)
+        if usage.window_start + window <= datetime.utcnow():
+            return Usage(room_id=room_id, window_start=datetime.utcnow(), chars=0)
+        return usage
+
+    def get_all_usage(self, window: timedelta) -> List[Usage]:
+        now = datetime.utcnow()
+        rows = self.db.execute(select([self.usage]).where(self.usage.c.window_start > now - window))
+        return [Usage(*row) for row in rows]
+
+    def add_usage(self, room_id: RoomID, chars: int, window: timedelta) -> Usage:
+        tbl = self.usage
+        now = datetime.utcnow()
+        rows = self.db.execute(select([tbl]).where(tbl.c.room_id == room_id))
+        try:
+            usage = Usage(*next(rows))
+        except (ValueError, StopIteration):
+            usage = Usage(room_id=room_id, window_start=now, chars=chars)
+            self.db.execute(tbl.insert().values(**usage._asdict()))
+            return usage
+        if usage.window_start + window <= now:
+            usage = Usage(room_id=room_id, window_start=now, chars=chars)
+        else:
+            usage = usage._replace(chars=usage.chars + chars)
+        self.db.execute(tbl.update()
+                        .where(tbl.c.room_id == room_id)
+                        .values(window_start=usage.window_start, chars=usage.chars))
+        return usage
+
+    def get_language_profile(self, room_id: RoomID, user_id: UserID) -> Dict[str, float]:
+        tbl = self.language_profile
+        rows = self.db.execute(select([tbl.c.language, tbl.c.weight])
+                               .where(and_(tbl.c.room_id == room_id, tbl.c.user_id == user_id)))
+        return {language: weight for language, weight in rows}
+
+    def set_language_profile(self, room_id: RoomID, user_id: UserID, profile: Dict[str, float]) -> None:
+        tbl = self.language_profile
+        self.db.execute(tbl.delete().where(and_(tbl.c.room_id == room_id, tbl.c.user_id == user_id)))
+        if profile:
+            self.db.execute(tbl.insert(), [{"room_id": room_id, "user_id": user_id, "language": language,
+                                            "weight": weight} for language, weight in profile.items()])
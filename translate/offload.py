@@ -0,0 +1,94 @@
+# translate - A maubot plugin to translate words.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Callable, NamedTuple, Optional, TypeVar
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import asyncio
+
+T = TypeVar("T")
+
+OffloadConfig = NamedTuple("OffloadConfig", type=str, workers=int, threshold=int, lag_interval=float)
+
+
+class Offloader:
+    """Runs CPU-bound text processing of large inputs in an executor instead of on the event loop.
+
+    Functions run in a process pool must be picklable, i.e. module-level functions or methods of
+    picklable objects. Steps whose arguments or results are about as expensive to pickle as to compute,
+    like JSON encoding and decoding, should pass allow_process=False to stay inline with process pools.
+    """
+    config: OffloadConfig
+    executor: Optional[Executor]
+    offloaded: int
+    inline: int
+    lag_avg: float
+    lag_max: float
+    _lag_task: Optional[asyncio.Task]
+
+    def __init__(self, config: OffloadConfig) -> None:
+        self.executor = None
+        self.offloaded = 0
+        self.inline = 0
+        self.lag_avg = 0.0
+        self.lag_max = 0.0
+        self._lag_task = None
+        self.set_config(config)
+
+    def set_config(self, config: OffloadConfig) -> None:
+        """Switch to a new configuration. Work already running in the old executor still finishes."""
+        old_executor = self.executor
+        self.config = config
+        if config.type == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=config.workers or None)
+        elif config.type == "process":
+            self.executor = ProcessPoolExecutor(max_workers=config.workers or None)
+        else:
+            self.executor = None
+        if old_executor:
+            old_executor.shutdown(wait=False)
+        if self._lag_task and config.lag_interval <= 0:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    async def run(self, size: int, func: Callable[..., T], *args: Any, allow_process: bool = True,
+                  force: bool = False) -> T:
+        """Run func(*args), in the executor if size is at least the threshold or force is set."""
+        if (self.executor is None or (size < self.config.threshold and not force)
+                or (not allow_process and isinstance(self.executor, ProcessPoolExecutor))):
+            self.inline += 1
+            return func(*args)
+        self.offloaded += 1
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def _measure_lag(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.config.lag_interval)
+            lag = max(loop.time() - start - self.config.lag_interval, 0)
+            self.lag_avg = self.lag_avg * 0.9 + lag * 0.1 if self.lag_avg else lag
+            self.lag_max = max(self.lag_max, lag)
+
+    def start(self) -> None:
+        if self.config.lag_interval > 0 and not self._lag_task:
+            self._lag_task = asyncio.ensure_future(self._measure_lag())
+
+    def stop(self) -> None:
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,76 @@
+# translate - A maubot plugin to translate words.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+
+from mautrix.types import RoomID, UserID
+
+from .db import Database
+from .util import ProfileConfig
+
+
+class LanguageProfiles:
+    """Languages each sender has recently written in, per room.
+
+    Every observed language adds a weight of 1 to the sender's profile after the existing weights have
+    been multiplied by the decay factor, so old observations are slowly forgotten. A profile is confident
+    once it has enough weight and a single language holds a large enough share of it.
+    """
+    config: ProfileConfig
+    db: Optional[Database]
+    profiles: 'OrderedDict[Tuple[RoomID, UserID], Dict[str, float]]'
+
+    def __init__(self, config: ProfileConfig, db: Optional[Database] = None) -> None:
+        self.profiles = OrderedDict()
+        self.set_config(config, db)
+
+    def set_config(self, config: ProfileConfig, db: Optional[Database] = None) -> None:
+        self.config = config
+        self.db = db if config.persist else None
+        while len(self.profiles) > self.config.max_size:
+            self.profiles.popitem(last=False)
+
+    def get(self, room_id: RoomID, user_id: UserID) -> Dict[str, float]:
+        key = (room_id, user_id)
+        try:
+            self.profiles.move_to_end(key)
+            return self.profiles[key]
+        except KeyError:
+            pass
+        profile = self.db.get_language_profile(room_id, user_id) if self.db else {}
+        self.profiles[key] = profile
+        while len(self.profiles) > self.config.max_size:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def update(self, room_id: RoomID, user_id: UserID, lang: str) -> None:
+        profile = self.get(room_id, user_id)
+        for known_lang in list(profile.keys()):
+            profile[known_lang] *= self.config.decay
+            if profile[known_lang] < 0.01:
+                del profile[known_lang]
+        lang = lang.lower()
+        profile[lang] = profile.get(lang, 0) + 1
+        if self.db:
+            self.db.set_language_profile(room_id, user_id, profile)
+
+    def prior(self, room_id: RoomID, user_id: UserID) -> Optional[str]:
+        profile = self.get(room_id, user_id)
+        total = sum(profile.values())
+        if not profile or total < self.config.min_weight:
+            return None
+        lang, weight = max(profile.items(), key=lambda item: item[1])
+        return lang if weight / total >= self.config.confidence else None
@@ -13,13 +13,20 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, NamedTuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
 from abc import ABC, abstractmethod
 
-Result = NamedTuple("TranslationResult", text=str, source_language=str)
+from ..offload import Offloader
+
+T = TypeVar("T")
+
+# sentences contains (source, translation) pairs of the sentences the provider translated.
+Result = NamedTuple("TranslationResult", text=str, source_language=str, sentences=List[Tuple[str, str]])
 
 
 class AbstractTranslationProvider(ABC):
+    offloader: Optional[Offloader] = None
+
     @abstractmethod
     def __init__(self, args: Dict) -> None:
         pass
@@ -28,6 +35,11 @@ class AbstractTranslationProvider(ABC):
     async def translate(self, text: str, to_lang: str, from_lang: str = "auto") -> Result:
         pass
 
+    async def run_cpu(self, size: int, func: Callable[..., T], *args: Any, allow_process: bool = True) -> T:
+        if self.offloader:
+            return await self.offloader.run(size, func, *args, allow_process=allow_process)
+        return func(*args)
+
     @abstractmethod
     def is_supported_language(self, code: str) -> bool:
         pass
@@ -50,18 +50,21 @@ class DeepLTranslate(AbstractTranslationProvider):
         self._request_id += 1
         return self._request_id
 
-    async def _make_request(self, method: str, params: Dict[str, Any], sess: ClientSession) -> Any:
+    async def _make_request(self, method: str, params: Dict[str, Any], sess: ClientSession,
+                            size: int = 0) -> Any:
         req = {
             "id": self.request_id,
             "method": f"LMT_{method}",
             "jsonrpc": "2.0",
             "params": params,
         }
-        resp = await sess.post(self.url, headers=self.headers, data=json.dumps(req))
-        return await resp.json(content_type=None)
+        data = await self.run_cpu(size, json.dumps, req, allow_process=False)
+        resp = await sess.post(self.url, headers=self.headers, data=data)
+        body = await resp.text()
+        return await self.run_cpu(len(body), json.loads, body, allow_process=False)
 
-    def _split_paragraphs(self, text: str) -> List[str]:
-        parts = (part.strip() for part in self.paragraph_regex.split(text))
+    async def _split_paragraphs(self, text: str) -> List[str]:
+        parts = (part.strip() for part in await self.run_cpu(len(text), self.paragraph_regex.split, text))
         return [part for part in parts if len(part) > 0]
 
     async def _req_split_sentences(self, paragraphs: List[str], from_lang: str, sess: ClientSession,
@@ -72,7 +75,7 @@ class DeepLTranslate(AbstractTranslationProvider):
                 "lang_user_selected": from_lang,
                 "user_preferred_langs": [],
             }
-        }, sess=sess)
+        }, sess=sess, size=sum(len(paragraph) for paragraph in paragraphs))
         print(data)
         return data["result"]["splitted_texts"], data["result"]["lang"]
 
@@ -97,7 +100,7 @@ class DeepLTranslate(AbstractTranslationProvider):
                 "target_lang": to_lang,
                 "user_preferred_langs": [],
             }
-        }, sess=sess)
+        }, sess=sess, size=sum(len(job["raw_en_sentence"]) for job in jobs))
         print(data)
         for ji, translation in enumerate(data["result"]["translations"].values()):
             pi, si = job_indexes[ji]
@@ -113,12 +116,15 @@ class DeepLTranslate(AbstractTranslationProvider):
         to_lang = to_lang.upper()
         async with ClientSession() as sess:
             paragraphs, from_lang_computed = await self._req_split_sentences(
-                self._split_paragraphs(text), sess=sess, from_lang=from_lang)
+                await self._split_paragraphs(text), sess=sess, from_lang=from_lang)
+            sources = [sentence for paragraph in paragraphs for sentence in paragraph]
             await asyncio.sleep(1)
             paragraphs = await self._req_translate(paragraphs, from_lang=from_lang_computed,
                                                    to_lang=to_lang, sess=sess)
             return Result(text="\n".join(" ".join(paragraph) for paragraph in paragraphs),
-                          source_language=from_lang_computed)
+                          source_language=from_lang_computed,
+                          sentences=list(zip(sources, (sentence for paragraph in paragraphs
+                                                       for sentence in paragraph))))
 
     def is_supported_language(self, code: str) -> bool:
         return code.upper() in self.supported_languages.keys()
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Dict
+import json
 
 from aiohttp import ClientSession
 from yarl import URL
@@ -66,9 +67,12 @@ class GoogleTranslate(AbstractTranslationProvider):
             resp = await sess.get(self.url.with_query({"client": "gtx", "dt": "t", "q": text,
                                                        "sl": from_lang, "tl": to_lang}),
                                   headers=self.headers)
-            data = await resp.json()
+            body = await resp.text()
+            data = await self.run_cpu(len(body), json.loads, body, allow_process=False)
             return Result(text="".join(item[0] for item in data[0] if len(item) > 0 and item[0]),
-                          source_language=data[8][0][0] if len(data) > 8 else data[2])
+                          source_language=data[8][0][0] if len(data) > 8 else data[2],
+                          sentences=[(item[1], item[0]) for item in data[0]
+                                     if len(item) > 1 and item[0] and item[1]])
 
     def is_supported_language(self, code: str) -> bool:
         return code.lower() in self.supported_languages.keys()
@@ -13,23 +13,42 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Tuple, NamedTuple, Set, Dict, TYPE_CHECKING
+from typing import Optional, Tuple, NamedTuple, Set, Dict, List, TYPE_CHECKING
 from importlib import import_module
+from datetime import timedelta
+from enum import IntEnum
 
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
-from mautrix.types import RoomID
+from mautrix.types import RoomID, EventID, UserID
 from maubot import MessageEvent
 from maubot.handlers.command import Argument
 
 import re
 
 from .provider import AbstractTranslationProvider
+from .offload import OffloadConfig
 
 if TYPE_CHECKING:
     from .bot import TranslatorBot
 
 AutoTranslateConfig = NamedTuple("AutoTranslateConfig", main_language=str,
-                                 accepted_languages=Set[str])
+                                 accepted_languages=Set[str], speculative=bool)
+BudgetConfig = NamedTuple("BudgetConfig", window=timedelta, room_limit=int, global_limit=int,
+                          degrade_at=float, priority_rooms=Set[RoomID])
+ProfileConfig = NamedTuple("ProfileConfig", enabled=bool, max_size=int, decay=float, min_weight=float,
+                           confidence=float, short_message=int, persist=bool)
+
+# A translation posted by the bot, kept so that edits of the original message can be translated incrementally.
+TranslatedMessage = NamedTuple("TranslatedMessage", event_id=EventID, sender=UserID, label=str, from_lang=str,
+                               sentences=List[Tuple[str, str]])
+
+
+class BudgetLevel(IntEnum):
+    OK = 0
+    # Only the first target language is translated.
+    DEGRADED = 1
+    # Nothing is translated automatically until the window resets.
+    EXHAUSTED = 2
 
 
 class TranslationProviderError(Exception):
@@ -41,7 +60,26 @@ class Config(BaseProxyConfig):
         helper.copy("provider.id")
         helper.copy("provider.args")
         helper.copy("auto_translate")
+        helper.copy("budget.window")
+        helper.copy("budget.room_limit")
+        helper.copy("budget.global_limit")
+        helper.copy("budget.degrade_at")
+        helper.copy("budget.priority_rooms")
+        helper.copy("admins")
         helper.copy("response_reply")
+        helper.copy("edit_cache_size")
+        helper.copy("speculative_translation")
+        helper.copy("language_profiles.enabled")
+        helper.copy("language_profiles.max_size")
+        helper.copy("language_profiles.decay")
+        helper.copy("language_profiles.min_weight")
+        helper.copy("language_profiles.confidence")
+        helper.copy("language_profiles.short_message")
+        helper.copy("language_profiles.persist")
+        helper.copy("executor.type")
+        helper.copy("executor.workers")
+        helper.copy("executor.threshold")
+        helper.copy("executor.lag_interval")
 
     def load_translator(self) -> AbstractTranslationProvider:
         try:
@@ -58,11 +96,68 @@ class Config(BaseProxyConfig):
     def load_auto_translate(self) -> Dict[RoomID, AutoTranslateConfig]:
         atc = {
             value.get("room_id"): AutoTranslateConfig(value.get("main_language", "en"),
-                                                         set(value.get("accepted_languages", [])))
+                                                         set(value.get("accepted_languages", [])),
+                                                         value.get("speculative", self["speculative_translation"]))
                for value in self["auto_translate"] if "room_id" in value
         }
         return atc
 
+    def load_budget(self) -> BudgetConfig:
+        return BudgetConfig(window=timedelta(seconds=self["budget.window"]),
+                            room_limit=self["budget.room_limit"],
+                            global_limit=self["budget.global_limit"],
+                            degrade_at=self["budget.degrade_at"],
+                            priority_rooms=set(self["budget.priority_rooms"] or []))
+
+    def load_profiles(self) -> ProfileConfig:
+        return ProfileConfig(enabled=self["language_profiles.enabled"],
+                             max_size=self["language_profiles.max_size"],
+                             decay=self["language_profiles.decay"],
+                             min_weight=self["language_profiles.min_weight"],
+                             confidence=self["language_profiles.confidence"],
+                             short_message=self["language_profiles.short_message"],
+                             persist=self["language_profiles.persist"])
+
+    def load_offload(self) -> OffloadConfig:
+        return OffloadConfig(type=self["executor.type"],
+                             workers=self["executor.workers"],
+                             threshold=self["executor.threshold"],
+                             lag_interval=self["executor.lag_interval"])
+
+
+def match_sentences(text: str, sentences: List[Tuple[str, str]]) -> List[Tuple[str, str, Optional[str]]]:
+    """Split text into the known source sentences and the parts in between them.
+
+    Returns (separator, source, translation) tuples in text order. The translation is None for parts of
+    the text that are not known sentences and still need to be translated.
+    """
+    pieces = []
+    pos = 0
+    for source, translation in sentences:
+        source = source.strip()
+        start = text.find(source, pos) if source else -1
+        if start < 0:
+            continue
+        if text[pos:start].strip():
+            pieces.append((pos, start, None))
+        pieces.append((start, start + len(source), translation.strip()))
+        pos = start + len(source)
+    if text[pos:].strip():
+        pieces.append((pos, len(text), None))
+
+    parts = []
+    prev_end = None
+    for start, end, translation in pieces:
+        chunk = text[start:end]
+        start += len(chunk) - len(chunk.lstrip())
+        if prev_end is None:
+            separator = ""
+        else:
+            separator = "\n" if "\n" in text[prev_end:start] else " "
+        parts.append((separator, chunk.strip(), translation))
+        prev_end = start + len(chunk.strip())
+    return parts
+
 
 class LanguageCodeAuto(Argument):
     def __init__(self, name: str, label: str = None, *, required: bool = False):
@@ -73,7 +168,7 @@ class LanguageCodeAuto(Argument):
         parts = val.split(" ", 1)
         if len(parts) < 2:
             parts.append("")
-        if parts[0] in ["setauto", "unsetauto", "help", "show"]:
+        if parts[0] in ["setauto", "unsetauto", "help", "show", "stats"]:
             return parts[1], parts[0]
         return val, None 
 